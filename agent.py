@@ -1,107 +1,316 @@
 import cycls
 import os
-import requests
+import orjson
+import atexit
+import asyncio
+import httpx
+import ijson
+import jinja2
+import pybreaker
+from cachetools import TTLCache
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_exponential
 import urllib.parse
-from openai import OpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 import dotenv
-from datetime import datetime, timedelta
-from ui import header, intro
+from datetime import date, datetime, timedelta
+from ui import header, intro, flights_style, flights_heading, flight_card, flights_footer
 
 dotenv.load_dotenv()
 
 agent = cycls.Agent(key = os.getenv("CYCLS_API_KEY"),
- pip=["requests", "openai", "python-dotenv"], copy=[".env"])
+ pip=["httpx[http2]", "cachetools", "ijson", "jinja2", "orjson", "pybreaker", "tenacity", "openai", "python-dotenv"], copy=[".env"])
 
-def duffel_request(endpoint: str, method: str = "GET", payload: dict = None) -> dict:
-    headers = {"Authorization": f"Bearer {os.getenv('DUFFEL_API_KEY')}", "Content-Type": "application/json", "Duffel-Version": "v2"}
+# Shared Duffel client, created lazily so the handler can still be pickled for deployment
+_duffel_client = None
+
+def get_duffel_client() -> httpx.AsyncClient:
+    global _duffel_client
+    if _duffel_client is None or _duffel_client.is_closed:
+        _duffel_client = httpx.AsyncClient(base_url="https://api.duffel.com", http2=True, timeout=httpx.Timeout(130.0, connect=5.0), limits=httpx.Limits(max_connections=32, max_keepalive_connections=16))
+    return _duffel_client
+
+@atexit.register
+def close_duffel_client():
+    if _duffel_client is not None and not _duffel_client.is_closed:
+        try:
+            asyncio.run(_duffel_client.aclose())
+        except Exception:
+            pass
+
+# Stops calling Duffel for a while after repeated failures instead of piling up slow requests.
+# Created lazily for the same reason as the client
+_duffel_breaker = None
+_duffel_breaker_storage = None
+
+def get_duffel_breaker() -> pybreaker.CircuitBreaker:
+    global _duffel_breaker, _duffel_breaker_storage
+    if _duffel_breaker is None:
+        _duffel_breaker_storage = pybreaker.CircuitMemoryStorage(pybreaker.STATE_CLOSED)
+        _duffel_breaker = pybreaker.CircuitBreaker(fail_max=5, reset_timeout=30, state_storage=_duffel_breaker_storage)
+    return _duffel_breaker
+
+async def call_with_duffel_breaker(send):
+    # Runs `send()` behind the Duffel circuit breaker, recording its outcome once it's known.
+    # A cancelled call (e.g. the user left mid-search) says nothing about Duffel's health, so it isn't
+    # recorded at all; pybreaker would count it as a failure, or as a success that clears earlier failures
+    breaker = get_duffel_breaker()
+    opened_at = _duffel_breaker_storage.opened_at
+    if breaker.current_state == pybreaker.STATE_OPEN and opened_at and datetime.now(opened_at.tzinfo) < opened_at + timedelta(seconds=breaker.reset_timeout):
+        raise pybreaker.CircuitBreakerError("Timeout not elapsed yet, circuit breaker still open")
+    
+    try:
+        result, error = await send(), None
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        result, error = None, e
+    
+    def outcome():
+        if error is not None:
+            raise error
+    
+    try:
+        breaker.call(outcome)
+    except Exception:
+        pass # This call's own result stands, even if recording it just opened the breaker
+    if error is not None:
+        raise error
+    return result
+
+# Compiled UI templates, keyed by their source; autoescaping keeps API data from injecting markup
+_jinja_env = None
+_templates = {}
+
+def render_template(source: str, **context) -> str:
+    global _jinja_env
+    template = _templates.get(source)
+    if template is None:
+        if _jinja_env is None:
+            _jinja_env = jinja2.Environment(autoescape=True)
+        template = _templates[source] = _jinja_env.from_string(source)
+    return template.render(**context)
+
+# Recently fetched offers, so booking doesn't fetch the same offer twice within a minute
+_offer_cache = TTLCache(maxsize=1024, ttl=60)
+
+def duffel_headers() -> dict:
+    return {"Authorization": f"Bearer {os.getenv('DUFFEL_API_KEY')}", "Content-Type": "application/json", "Duffel-Version": "v2"}
+
+def duffel_error(r: httpx.Response) -> dict:
+    # Gateway errors (502/503/504) often come back as HTML rather than JSON
+    try:
+        error_data = orjson.loads(r.content) if r.content else {}
+    except orjson.JSONDecodeError:
+        error_data = {}
+    if not isinstance(error_data, dict):
+        error_data = {}
+    return {"error": error_data.get("errors", [{"message": f"HTTP {r.status_code}: {r.text}"}])}
+
+DUFFEL_UNAVAILABLE = {"error": "Duffel is temporarily unavailable. Please try again in a minute."}
+
+class DuffelServerError(Exception):
+    # Raised for 5xx responses so they count as circuit breaker failures and GETs retry them
+    def __init__(self, response: httpx.Response):
+        super().__init__(f"HTTP {response.status_code}")
+        self.response = response
+
+async def duffel_request(endpoint: str, method: str = "GET", payload: dict = None) -> dict:
+    headers = duffel_headers()
     try:
+        client = get_duffel_client()
         if method == "POST":
-            r = requests.post(f"https://api.duffel.com/{endpoint}", headers=headers, json=payload, timeout=30)
+            # Never retried: creating an order twice could double-book
+            async def send():
+                r = await client.post(f"/{endpoint}", headers=headers, content=orjson.dumps(payload))
+                if r.status_code >= 500:
+                    raise DuffelServerError(r)
+                return r
         else:
-            r = requests.get(f"https://api.duffel.com/{endpoint}", headers=headers, timeout=30)
+            # GETs are safe to repeat, so retry transient failures with exponential backoff.
+            # The breaker wraps the whole retry loop so one request counts once, however many attempts it took
+            async def send():
+                async for attempt in AsyncRetrying(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, max=8), retry=retry_if_exception_type((httpx.TransportError, httpx.TimeoutException, DuffelServerError)), reraise=True):
+                    with attempt:
+                        r = await client.get(f"/{endpoint}", headers=headers)
+                        if r.status_code >= 500:
+                            raise DuffelServerError(r)
+                return r
+        r = await call_with_duffel_breaker(send)
         
         if r.status_code >= 400:
-            error_data = r.json() if r.content else {}
-            return {"error": error_data.get("errors", [{"message": f"HTTP {r.status_code}: {r.text}"}])}
+            return duffel_error(r)
         
-        return r.json()
+        return orjson.loads(r.content)
+    except DuffelServerError as e:
+        return duffel_error(e.response)
+    except pybreaker.CircuitBreakerError:
+        return DUFFEL_UNAVAILABLE
+    except Exception as e:
+        return {"error": str(e)}
+
+# Duffel Airways usually has 'owner' -> 'iata_code' = 'ZZ' or 'name' = 'Duffel Airways'
+DUFFEL_AIRWAYS_IATA_CODES = {"ZZ"}
+
+def is_duffel_airways(offer: dict) -> bool:
+    owner = offer.get("owner")
+    if not owner:
+        return False
+    # The IATA code is the cheap, reliable check; the name only covers owners without one
+    return owner.get("iata_code") in DUFFEL_AIRWAYS_IATA_CODES or owner.get("name") == "Duffel Airways"
+
+async def duffel_offer_request(payload: dict, limit: int = 5) -> dict:
+    # Offer requests can return hundreds of offers, so parse the response as it streams in
+    # and only keep the top `limit` offers instead of building every one of them.
+    # Duffel Airways (ZZ) offers come first for reliable testing, otherwise Duffel's order is kept
+    async def send():
+        async with get_duffel_client().stream("POST", "/air/offer_requests", headers=duffel_headers(), content=orjson.dumps(payload)) as r:
+            if r.status_code >= 400:
+                await r.aread()
+                if r.status_code >= 500:
+                    raise DuffelServerError(r)
+                return duffel_error(r)
+            
+            offer_request_id, passengers = "", []
+            duffel_airways_offers, other_offers = [], []
+            builder, builder_prefix = None, None
+            events = ijson.sendable_list()
+            parser = ijson.parse_coro(events, use_float=True)
+            
+            def consume(chunk: bytes = None):
+                nonlocal offer_request_id, builder, builder_prefix
+                if chunk is None:
+                    parser.close()
+                else:
+                    parser.send(chunk)
+                for prefix, event, value in events:
+                    if builder_prefix is None:
+                        if event == "start_map" and prefix in ("data.offers.item", "data.passengers.item"):
+                            builder_prefix = prefix
+                            # Once there are enough Duffel Airways offers no later offer can make the cut, so skip building it
+                            skip = prefix == "data.offers.item" and len(duffel_airways_offers) >= limit
+                            builder = None if skip else ijson.ObjectBuilder()
+                        elif prefix == "data.id":
+                            offer_request_id = value
+                            continue
+                        else:
+                            continue
+                    if builder is not None:
+                        builder.event(event, value)
+                    if event == "end_map" and prefix == builder_prefix:
+                        item = builder.value if builder is not None else None
+                        if item is None:
+                            pass # Skipped offer
+                        elif builder_prefix == "data.passengers.item":
+                            passengers.append(item)
+                        elif is_duffel_airways(item):
+                            duffel_airways_offers.append(item)
+                        elif len(other_offers) < limit:
+                            other_offers.append(item)
+                        builder, builder_prefix = None, None
+                del events[:]
+            
+            async for chunk in r.aiter_bytes():
+                consume(chunk)
+            consume()
+            
+        offers = (duffel_airways_offers + other_offers)[:limit]
+        return {"data": {"id": offer_request_id, "passengers": passengers, "offers": offers}}
+    
+    try:
+        return await call_with_duffel_breaker(send)
+    except DuffelServerError as e:
+        return duffel_error(e.response)
+    except pybreaker.CircuitBreakerError:
+        return DUFFEL_UNAVAILABLE
     except Exception as e:
         return {"error": str(e)}
 
-def search_flights(origin: str, destination: str, departure_date: str, passengers: int = 1):
-    result = duffel_request("air/offer_requests", "POST", {"data": {"slices": [{"origin": origin, "destination": destination, "departure_date": departure_date}], "passengers": [{"type": "adult"}] * passengers, "cabin_class": "economy"}}) 
+def hhmm(timestamp: str) -> str:
+    # Duffel timestamps are ISO 8601 (YYYY-MM-DDTHH:MM:SS), so the time of day is a fixed slice
+    return timestamp[11:16] if len(timestamp) >= 16 and timestamp[10] == "T" else "N/A"
+
+async def search_flights(origin: str, destination: str, departure_date: str, passengers: int = 1):
+    result = await duffel_offer_request({"data": {"slices": [{"origin": origin, "destination": destination, "departure_date": departure_date}], "passengers": [{"type": "adult"}] * passengers, "cabin_class": "economy"}}) 
     if "error" in result or "errors" in result:
         errors = result.get('errors', [result.get('error')])
         if isinstance(errors, list) and len(errors) > 0:
             error_msg = errors[0].get('message', str(errors[0])) if isinstance(errors[0], dict) else str(errors[0])
             return {"success": False, "error": "❌ Sorry, the departure date must be in the future. Please choose a date starting from tomorrow or later."} if 'must be after' in error_msg else {"success": False, "error": f"❌ {error_msg}"}
         return {"success": False, "error": f"❌ Error: {errors}"}
-    offers = result.get("data", {}).get("offers", [])
+    offer_request_data = result.get("data") or {}
+    # Offers arrive already limited to the top 5, with Duffel Airways first
+    offers = offer_request_data.get("offers") or []
     if not offers:
         return {"success": False, "error": "No flights found for your search criteria."}
     
-    # Sort offers to prioritize Duffel Airways (ZZ) for reliable testing
-    # Duffel Airways usually has 'owner' -> 'iata_code' = 'ZZ' or 'name' = 'Duffel Airways'
-    offers.sort(key=lambda x: 0 if x.get("owner", {}).get("name") == "Duffel Airways" or x.get("owner", {}).get("iata_code") == "ZZ" else 1)
-    
-    offers = offers[:5] # Take top 5 after sorting
-    
-    offer_request_data = result.get("data", {})
-    passenger_ids = [p.get("id") for p in offer_request_data.get("passengers", [])]
+    passenger_ids = [p.get("id") for p in offer_request_data.get("passengers") or []]
     offer_request_id = offer_request_data.get("id", "")
     
     flights_data = []
     for offer in offers:
+        first_slice = offer["slices"][0]
+        segments = first_slice["segments"]
         flights_data.append({
             "offer_id": offer.get("id", ""),
             "airline": offer["owner"]["name"],
             "price": f"{offer['total_amount']} {offer['total_currency']}",
             "total_amount": offer.get("total_amount"),
             "total_currency": offer.get("total_currency"),
-            "duration": offer["slices"][0]["duration"],
-            "stops": len(offer["slices"][0].get("segments", [{}])) - 1,
-            "departure": offer["slices"][0]["segments"][0].get("departing_at", "N/A").split("T")[1][:5] if "T" in offer["slices"][0]["segments"][0].get("departing_at", "") else "N/A",
-            "arrival": offer["slices"][0]["segments"][-1].get("arriving_at", "N/A").split("T")[1][:5] if "T" in offer["slices"][0]["segments"][-1].get("arriving_at", "") else "N/A"
+            "duration": first_slice["duration"],
+            "stops": len(segments) - 1,
+            "departure": hhmm(segments[0].get("departing_at") or ""),
+            "arrival": hhmm(segments[-1].get("arriving_at") or "")
         })
     
     return {"success": True, "flights": flights_data, "origin": origin, "destination": destination, "passenger_ids": passenger_ids, "offer_request_id": offer_request_id}
 
-def get_offer(offer_id: str):
-    result = duffel_request(f"air/offers/{offer_id}", "GET")
+async def get_offer(offer_id: str):
+    cached = _offer_cache.get(offer_id)
+    if cached is not None:
+        return cached
+    result = await duffel_request(f"air/offers/{offer_id}", "GET")
     if "error" in result or "errors" in result:
         errors = result.get('errors', [result.get('error')])
         if isinstance(errors, list) and len(errors) > 0:
             error_msg = errors[0].get('message', str(errors[0])) if isinstance(errors[0], dict) else str(errors[0])
             # If offer doesn't exist, it might have expired - this is okay, we can still try to create order
             if "does not exist" in error_msg.lower() or "not found" in error_msg.lower():
+                _offer_cache.pop(offer_id, None)
                 return {"success": False, "error": f"❌ Offer may have expired. Error: {error_msg}", "expired": True}
             return {"success": False, "error": f"❌ {error_msg}"}
         return {"success": False, "error": f"❌ Error: {errors}"}
-    offer_data = result.get("data", {})
+    offer_data = result.get("data") or {}
     if not offer_data:
+        _offer_cache.pop(offer_id, None)
         return {"success": False, "error": "❌ No offer data returned", "expired": True}
     
     # Extract passenger IDs from the offer to ensure we use the correct ones for booking
-    passenger_ids = [p.get("id") for p in offer_data.get("passengers", [])]
+    passenger_ids = [p.get("id") for p in offer_data.get("passengers") or []]
     
-    return {
+    offer_result = {
         "success": True, 
         "offer": offer_data, 
         "total_amount": offer_data.get("total_amount"), 
         "total_currency": offer_data.get("total_currency"),
         "passenger_ids": passenger_ids
     }
+    _offer_cache[offer_id] = offer_result
+    return offer_result
 
-def create_order(offer_id: str, passengers: list, payment_type: str = "balance", total_amount: float = None, total_currency: str = None):
-    # Try to get the latest offer to ensure price is up-to-date
-    # If it fails (offer expired), use provided amounts as fallback
-    offer_result = get_offer(offer_id)
-    if offer_result.get("success"):
-        total_amount = offer_result.get("total_amount")
-        total_currency = offer_result.get("total_currency")
-    elif offer_result.get("expired") and (total_amount is None or total_currency is None):
-        # If get_offer failed because offer expired and we don't have fallback amounts, return error
-        return {"success": False, "error": "❌ This offer has expired. Please search for flights again to get a fresh offer."}
+async def create_order(offer_id: str, passengers: list, payment_type: str = "balance", total_amount: str = None, total_currency: str = None):
+    # If the amounts were provided (normally copied from get_offer), trust them and skip the extra round-trip;
+    # Duffel rejects the order itself with offer_no_longer_available if the offer is no longer valid
+    if total_amount is not None and total_currency is not None:
+        total_amount = str(total_amount) # Duffel amounts are decimal strings
+    else:
+        # Otherwise get the latest offer to fill in the price
+        offer_result = await get_offer(offer_id)
+        if offer_result.get("success"):
+            total_amount = offer_result.get("total_amount")
+            total_currency = offer_result.get("total_currency")
+        elif offer_result.get("expired"):
+            # If get_offer failed because offer expired and we don't have fallback amounts, return error
+            return {"success": False, "error": "❌ This offer has expired. Please search for flights again to get a fresh offer."}
     
     payload = {
         "data": {
@@ -115,7 +324,7 @@ def create_order(offer_id: str, passengers: list, payment_type: str = "balance",
         }
     }
     
-    result = duffel_request("air/orders", "POST", payload)
+    result = await duffel_request("air/orders", "POST", payload)
     if "error" in result or "errors" in result:
         errors = result.get('errors', [result.get('error')])
         if isinstance(errors, list) and len(errors) > 0:
@@ -124,32 +333,158 @@ def create_order(offer_id: str, passengers: list, payment_type: str = "balance",
             
             # Specific handling for expired offers in test mode
             if isinstance(error_obj, dict) and error_obj.get('code') == 'offer_no_longer_available':
+                _offer_cache.pop(offer_id, None)
                 return {"success": False, "error": "❌ This flight offer has expired or is no longer available. In Test Mode, please try booking a 'Duffel Airways' flight for guaranteed success."}
                 
             return {"success": False, "error": f"❌ {error_msg}"}
         return {"success": False, "error": f"❌ Error: {errors}"}
     
-    order_data = result.get("data", {})
+    # A booked offer can't be booked again, so drop it from the cache
+    _offer_cache.pop(offer_id, None)
+    order_data = result.get("data") or {}
     return {"success": True, "order": order_data, "booking_reference": order_data.get("booking_reference"), "order_id": order_data.get("id")}
 
-@agent("flightagent", header=header, intro=intro, auth=True)
-async def flight_agent(context):
-    import os
-    from openai import OpenAI
-    import dotenv
-    from datetime import datetime, timedelta
-    import json
-    dotenv.load_dotenv()
-    openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))  
-    today = datetime.now()
-    tomorrow = today + timedelta(days=1)  
+async def handle_search_flights(args: dict):
+    result = await search_flights(origin=args.get("origin"), destination=args.get("destination"), departure_date=args.get("departure_date"), passengers=args.get("passengers", 1))
+
+    if result.get("success"):
+        flights = result.get("flights", [])
+        origin = result.get("origin")
+        destination = result.get("destination")
+
+        # Main container opens with the shared styles, then the per-search heading.
+        # Each part is streamed as soon as it's ready, matching the staggered card animation
+        yield flights_style + render_template(flights_heading, destination=destination, origin=origin, count=len(flights))
+        encoded_route = urllib.parse.quote(f" from {origin} to {destination} at")
+        encoded_airlines = {}
+
+        for idx, flight in enumerate(flights, 1):
+            price_parts = flight['price'].split()
+            price_amount = price_parts[0]
+            price_currency = price_parts[1] if len(price_parts) > 1 else ''
+
+            # Logic for stops display
+            is_direct = flight['stops'] == 0
+            stops_text = 'Direct' if is_direct else f"{flight['stops']} Stop{'s' if flight['stops'] > 1 else ''}"
+            stops_color = '#10b981' if is_direct else '#f59e0b' # Green for direct, Amber for stops
+
+            # Booking URL construction: sends "Book Flight {idx} (ID: {offer_id}): {airline} from {origin} to {destination} at {price}".
+            # Offer IDs and prices are URL-safe already, so only the airline and route need escaping
+            offer_id = flight.get('offer_id', '')
+            airline = flight['airline']
+            if airline not in encoded_airlines:
+                encoded_airlines[airline] = urllib.parse.quote(airline)
+            booking_url = f"https://cycls.com/send/Book%20Flight%20{idx}%20%28ID%3A%20{offer_id}%29%3A%20{encoded_airlines[airline]}{encoded_route}%20{price_amount}%20{price_currency}"
+
+            # Animation delay calculation
+            anim_delay = (idx - 1) * 0.15
+
+            # Card HTML
+            yield render_template(flight_card, flight=flight, idx=idx, origin=origin, destination=destination, price_amount=price_amount, price_currency=price_currency, stops_text=stops_text, stops_color=stops_color, booking_url=booking_url, anim_delay=anim_delay)
+
+        yield flights_footer
+    else:
+        yield f"<div style='padding: 20px; color: red; background: #fee; border-radius: 8px; font-family: sans-serif;'>{result.get('error')}</div>"
+
+async def handle_get_offer(args: dict):
+    result = await get_offer(offer_id=args.get("offer_id"))
+    if result.get("success"):
+        offer = result.get("offer", {})
+        total_amount = result.get("total_amount")
+        total_currency = result.get("total_currency")
+        passenger_ids = result.get("passenger_ids", [])
+        yield f"✅ Offer retrieved successfully. Current price: {total_amount} {total_currency} (pass total_amount={total_amount} and total_currency={total_currency} to create_order).\n\nIMPORTANT for Agent: You MUST use these Passenger IDs for the booking: {passenger_ids}\n\nPlease collect passenger details (Name, DOB, Gender, Email, Phone + Country Code)."
+    elif result.get("expired"):
+        yield f"⚠️ {result.get('error')} You can still proceed with booking using the original offer price."
+    else:
+        yield f"<div style='padding: 20px; color: red; background: #fee; border-radius: 8px; font-family: sans-serif;'>{result.get('error')}</div>"
+
+async def handle_create_order(args: dict):
+    result = await create_order(
+        offer_id=args.get("offer_id"), 
+        passengers=args.get("passengers"), 
+        payment_type=args.get("payment_type", "balance"),
+        total_amount=args.get("total_amount"),
+        total_currency=args.get("total_currency")
+    )
+    if result.get("success"):
+        booking_ref = result.get("booking_reference")
+        order_id = result.get("order_id")
+        yield f"""<div style='padding: 24px; background: linear-gradient(135deg, #10b981 0%, #059669 100%); border-radius: 12px; color: white; font-family: sans-serif;'>
+            <h2 style='margin: 0 0 16px 0; font-size: 24px;'>🎉 Booking Confirmed!</h2>
+            <p style='margin: 8px 0; font-size: 16px;'><strong>Booking Reference:</strong> {booking_ref}</p>
+            <p style='margin: 8px 0; font-size: 16px;'><strong>Order ID:</strong> {order_id}</p>
+            <p style='margin: 16px 0 0 0; font-size: 14px; opacity: 0.9;'>Your flight has been successfully booked. You can use the booking reference to check your reservation on the airline's website.</p>
+        </div>"""
+    else:
+        yield f"<div style='padding: 20px; color: red; background: #fee; border-radius: 8px; font-family: sans-serif;'>{result.get('error')}</div>"
+
+TOOL_HANDLERS = {"search_flights": handle_search_flights, "get_offer": handle_get_offer, "create_order": handle_create_order}
+
+def start_tool_call(name: str, arguments: str):
+    # Runs a tool in the background, buffering its output in a queue (None marks the end)
+    queue = asyncio.Queue()
+    
+    async def drain():
+        try:
+            async for chunk in TOOL_HANDLERS[name](orjson.loads(arguments or "{}")):
+                await queue.put(chunk)
+        finally:
+            await queue.put(None)
+    
+    return queue, asyncio.create_task(drain())
+
+# Tools that change something on Duffel's side. They only start once the model's response has fully arrived
+# and are never cancelled mid-request, since an abandoned order may still have been placed
+BOOKING_TOOLS = {"create_order"}
+
+# Strong references to bookings that outlived their turn, so they aren't garbage-collected before finishing
+_background_tasks = set()
+
+def finish_in_background(name: str, queue: asyncio.Queue, task: asyncio.Task):
+    # Lets a tool run to completion after the user has gone, logging the output they never saw
+    def report(task):
+        _background_tasks.discard(task)
+        unseen = []
+        while not queue.empty():
+            if (chunk := queue.get_nowait()) is not None:
+                unseen.append(chunk)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"{name} failed after the user left: {task.exception()!r}")
+        elif unseen:
+            print(f"{name} finished after the user left:\n{''.join(unseen)}")
     
-    messages = [{"role": "system", "content": f"""You are a helpful flight booking assistant.
+    _background_tasks.add(task)
+    task.add_done_callback(report)
+
+async def stream_tool_outputs(started: list, separate: bool = False):
+    # Tools run concurrently (e.g. two get_offer calls cost one round-trip), but their
+    # output is streamed in call order, each chunk as soon as it's produced
+    for i, (queue, _) in enumerate(started):
+        if i or separate:
+            yield "\n\n"
+        while (chunk := await queue.get()) is not None:
+            yield chunk
+    # Surface any handler errors
+    await asyncio.gather(*[task for _, task in started])
+
+# Shared OpenAI client, created on the first turn (see get_duffel_client)
+_openai_client = None
+
+def get_openai_client() -> AsyncOpenAI:
+    global _openai_client
+    if _openai_client is None:
+        # Load the .env copied into the deployed agent before any API keys are read
+        dotenv.load_dotenv()
+        _openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=DefaultAsyncHttpxClient(limits=httpx.Limits(max_connections=32, max_keepalive_connections=16)))
+    return _openai_client
+
+SYSTEM_PROMPT = """You are a helpful flight booking assistant.
         Your job is to help users find and book flights.
         - Greet users warmly and ask how you can help with their travel plans
         - When they want to search flights, ask for: origin, destination, and departure date
-        - IMPORTANT: Today is {today.strftime('%Y-%m-%d')}. When user says "tomorrow", use {tomorrow.strftime('%Y-%m-%d')}
-        - Departure dates must be {tomorrow.strftime('%Y-%m-%d')} or later (no same-day bookings)
+        - IMPORTANT: Today is {today}. When user says "tomorrow", use {tomorrow}
+        - Departure dates must be {tomorrow} or later (no same-day bookings)
         - Once you have all details, use the search_flights tool. 
         - NOTE: If using a test API key, "Duffel Airways" is the most reliable airline for booking testing. Recommend it if available.
         - When user selects a flight (via "Book Flight X" message), the message will contain the Offer ID (e.g., "ID: off_..."). Extract this ID.
@@ -157,118 +492,83 @@ async def flight_agent(context):
         - Collect passenger details: given_name, family_name, email, phone_number, born_on (YYYY-MM-DD), gender (m/f), title (mr/mrs/ms/miss)
         - IMPORTANT: Phone numbers MUST be in E.164 format (e.g., +14155552671). Ask user for country code if missing.
         - Use the passenger_ids returned by get_offer - map them in order (first ID for first passenger, etc.). Do NOT make up IDs.
-        - Once you have all passenger details, use create_order to complete the booking
+        - Once you have all passenger details, use create_order to complete the booking. Always pass the total_amount and total_currency returned by get_offer
         - Display booking confirmation with booking_reference when order is created successfully
-        - Be conversational and friendly throughout"""}]
-    messages.extend([{"role": msg["role"], "content": msg["content"]} for msg in context.messages])
+        - Be conversational and friendly throughout"""
+
+# The prompt only changes once a day, so keep today's system message
+_system_messages = {}
+
+def get_system_message(day: date) -> dict:
+    message = _system_messages.get(day)
+    if message is None:
+        _system_messages.clear()
+        message = _system_messages[day] = {"role": "system", "content": SYSTEM_PROMPT.format(today=day.isoformat(), tomorrow=(day + timedelta(days=1)).isoformat())}
+    return message
+
+TOOLS = [
+    {"type": "function", "function": {"name": "search_flights", "description": "Search for flights between two airports on a specific date", "parameters": {"type": "object", "properties": {"origin": {"type": "string", "description": "Origin airport code (e.g., 'JFK', 'CAI')"}, "destination": {"type": "string", "description": "Destination airport code (e.g., 'LAX', 'JFK')"}, "departure_date": {"type": "string", "description": "Date in YYYY-MM-DD format (must be tomorrow or later)"}, "passengers": {"type": "integer", "description": "Number of passengers", "default": 1}}, "required": ["origin", "destination", "departure_date"]}}},
+    {"type": "function", "function": {"name": "get_offer", "description": "Retrieve the latest version of an offer to get up-to-date pricing and passenger IDs before booking", "parameters": {"type": "object", "properties": {"offer_id": {"type": "string", "description": "The offer ID from search results"}}, "required": ["offer_id"]}}},
+    {"type": "function", "function": {"name": "create_order", "description": "Create a booking order for a selected flight offer", "parameters": {"type": "object", "properties": {"offer_id": {"type": "string", "description": "The offer ID to book"}, "passengers": {"type": "array", "description": "Array of passenger objects", "items": {"type": "object", "properties": {"id": {"type": "string", "description": "The passenger ID from the get_offer response"}, "given_name": {"type": "string"}, "family_name": {"type": "string"}, "gender": {"type": "string", "enum": ["m", "f"]}, "title": {"type": "string", "enum": ["mr", "ms", "mrs", "miss", "dr"]}, "born_on": {"type": "string", "description": "YYYY-MM-DD"}, "email": {"type": "string"}, "phone_number": {"type": "string", "description": "E.164 format (e.g. +14155552671)"}}, "required": ["id", "given_name", "family_name", "gender", "born_on", "email", "phone_number"]}}, "payment_type": {"type": "string", "description": "Payment type: 'balance' or 'arc_bsp_cash'", "default": "balance"}, "total_amount": {"type": "string", "description": "Total amount exactly as returned by get_offer (e.g. '123.45')"}, "total_currency": {"type": "string", "description": "Currency code as returned by get_offer"}}, "required": ["offer_id", "passengers"]}}}
+]
+
+@agent("flightagent", header=header, intro=intro, auth=True)
+async def flight_agent(context):
+    openai_client = get_openai_client()
     
-    tools = [
-        {"type": "function", "function": {"name": "search_flights", "description": "Search for flights between two airports on a specific date", "parameters": {"type": "object", "properties": {"origin": {"type": "string", "description": "Origin airport code (e.g., 'JFK', 'CAI')"}, "destination": {"type": "string", "description": "Destination airport code (e.g., 'LAX', 'JFK')"}, "departure_date": {"type": "string", "description": "Date in YYYY-MM-DD format (must be tomorrow or later)"}, "passengers": {"type": "integer", "description": "Number of passengers", "default": 1}}, "required": ["origin", "destination", "departure_date"]}}},
-        {"type": "function", "function": {"name": "get_offer", "description": "Retrieve the latest version of an offer to get up-to-date pricing and passenger IDs before booking", "parameters": {"type": "object", "properties": {"offer_id": {"type": "string", "description": "The offer ID from search results"}}, "required": ["offer_id"]}}},
-        {"type": "function", "function": {"name": "create_order", "description": "Create a booking order for a selected flight offer", "parameters": {"type": "object", "properties": {"offer_id": {"type": "string", "description": "The offer ID to book"}, "passengers": {"type": "array", "description": "Array of passenger objects", "items": {"type": "object", "properties": {"id": {"type": "string", "description": "The passenger ID from the get_offer response"}, "given_name": {"type": "string"}, "family_name": {"type": "string"}, "gender": {"type": "string", "enum": ["m", "f"]}, "title": {"type": "string", "enum": ["mr", "ms", "mrs", "miss", "dr"]}, "born_on": {"type": "string", "description": "YYYY-MM-DD"}, "email": {"type": "string"}, "phone_number": {"type": "string", "description": "E.164 format (e.g. +14155552671)"}}, "required": ["id", "given_name", "family_name", "gender", "born_on", "email", "phone_number"]}}, "payment_type": {"type": "string", "description": "Payment type: 'balance' or 'arc_bsp_cash'", "default": "balance"}, "total_amount": {"type": "number", "description": "Total amount from offer"}, "total_currency": {"type": "string", "description": "Currency code"}}, "required": ["offer_id", "passengers"]}}}
-    ]
+    # cycls already gives text-only {"role", "content"} messages, so they can be passed through as-is
+    messages = [get_system_message(date.today()), *context.messages]
     
-    completion = openai_client.chat.completions.create(model="gpt-4o", messages=messages, tools=tools, tool_choice="auto", temperature=0.7)
-    response_msg = completion.choices[0].message
+    stream = await openai_client.chat.completions.create(model="gpt-4o", messages=messages, tools=TOOLS, tool_choice="auto", temperature=0.7, stream=True)
     
-    if response_msg.tool_calls:
-        for tool_call in response_msg.tool_calls:
-            if tool_call.function.name == "search_flights":
-                args = json.loads(tool_call.function.arguments)
-                result = search_flights(origin=args.get("origin"), destination=args.get("destination"), departure_date=args.get("departure_date"), passengers=args.get("passengers", 1))
-                
-                if result.get("success"):
-                    flights = result.get("flights", [])
-                    origin = result.get("origin")
-                    destination = result.get("destination")
-                    
-                    # Main container styling: Fixed height wrapper to contain layout during streaming
-                    # Includes animation styles for staggered card entry
-                    all_cards = '<style>@keyframes slideUpFade{from{opacity:0;transform:translateY(20px)}to{opacity:1;transform:translateY(0)}} .flight-container { width: 100%; } @media (min-width: 768px) { .flight-container { min-width: 600px; } }</style>'
-                    all_cards += '<div class="flight-container" style="min-height:600px; box-sizing:border-box; font-family:-apple-system,BlinkMacSystemFont,\'Segoe UI\',Roboto,Helvetica,Arial,sans-serif;">'
-                    all_cards += f'<div style="margin-bottom:24px; text-align:center; animation:slideUpFade 0.5s ease-out forwards;"><h2 style="margin:0; font-size:24px; font-weight:700; color:#111827;">✈️ Flights to {destination}</h2><p style="margin:8px 0 0 0; color:#6b7280; font-size:14px;">Found {len(flights)} options from {origin}</p></div>'
-                    
-                    for idx, flight in enumerate(flights, 1):
-                        price_parts = flight['price'].split()
-                        price_amount = price_parts[0]
-                        price_currency = price_parts[1] if len(price_parts) > 1 else ''
-                        
-                        # Logic for stops display
-                        is_direct = flight['stops'] == 0
-                        stops_text = 'Direct' if is_direct else f"{flight['stops']} Stop{'s' if flight['stops'] > 1 else ''}"
-                        stops_color = '#10b981' if is_direct else '#f59e0b' # Green for direct, Amber for stops
-                        
-                        # Booking URL construction
-                        offer_id = flight.get('offer_id', '')
-                        airline = flight['airline']
-                        booking_message = f'Book Flight {idx} (ID: {offer_id}): {airline} from {origin} to {destination} at {price_amount} {price_currency}'
-                        booking_url = f"https://cycls.com/send/{urllib.parse.quote(booking_message)}"
-                        
-                        # Animation delay calculation
-                        anim_delay = (idx - 1) * 0.15
-                        
-                        # Card HTML
-                        all_cards += f'<div style="background:#ffffff; border-radius:16px; box-shadow:0 4px 20px rgba(0,0,0,0.08); margin-bottom:24px; overflow:hidden; width:100%; border:1px solid #f3f4f6; opacity:0; animation:slideUpFade 0.5s ease-out {anim_delay}s forwards;">'
-                        
-                        # Header: Airline & Price
-                        all_cards += f'<div style="padding: 20px 24px; border-bottom: 1px solid #f3f4f6; display: flex; justify-content: space-between; align-items: center; background: #ffffff;">'
-                        all_cards += f'<div style="display: flex; align-items: center; gap: 12px;">'
-                        all_cards += f'<div style="width: 40px; height: 40px; background: #f3f4f6; border-radius: 10px; display: flex; align-items: center; justify-content: center; color: #4b5563;"><svg style="width:20px;height:20px;" fill="none" stroke="currentColor" viewBox="0 0 24 24"><path stroke-linecap="round" stroke-linejoin="round" stroke-width="2" d="M12 19l9 2-9-18-9 18 9-2zm0 0v-8"></path></svg></div>'
-                        all_cards += f'<div><h3 style="margin: 0; font-size: 16px; font-weight: 700; color: #111827;">{flight["airline"]}</h3><div style="font-size: 12px; color: #6b7280; margin-top: 2px;">Flight {idx}</div></div>'
-                        all_cards += f'</div><div style="text-align: right;"><div style="font-size: 20px; font-weight: 800; color: #111827;">{price_amount} <span style="font-size: 14px; font-weight: 500; color: #6b7280;">{price_currency}</span></div></div></div>'
-                        
-                        # Body: Times & Route
-                        all_cards += f'<div style="padding: 24px; display: flex; align-items: center; justify-content: space-between; gap: 16px;">'
-                        all_cards += f'<div style="text-align: left; flex: 1;"><div style="font-size: 24px; font-weight: 700; color: #111827; line-height: 1.2;">{flight["departure"]}</div><div style="font-size: 14px; font-weight: 600; color: #9ca3af; margin-top: 4px;">{origin}</div></div>'
-                        all_cards += f'<div style="flex: 2; display: flex; flex-direction: column; align-items: center; position: relative; padding: 0 10px;"><div style="font-size: 12px; font-weight: 600; color: #6b7280; margin-bottom: 8px;">{flight["duration"]}</div>'
-                        all_cards += f'<div style="width: 100%; height: 2px; background: #e5e7eb; position: relative; border-radius: 2px;"><div style="position: absolute; top: 50%; left: 50%; transform: translate(-50%, -50%); background: {stops_color}; padding: 0 8px; font-size: 10px; font-weight: 700; color: white; border-radius: 10px; line-height: 16px; white-space: nowrap;">{stops_text}</div></div></div>'
-                        all_cards += f'<div style="text-align: right; flex: 1;"><div style="font-size: 24px; font-weight: 700; color: #111827; line-height: 1.2;">{flight["arrival"]}</div><div style="font-size: 14px; font-weight: 600; color: #9ca3af; margin-top: 4px;">{destination}</div></div></div>'
-                        
-                        # Footer: Action
-                        all_cards += f'<div style="padding: 16px 24px; background: #f9fafb; border-top: 1px solid #f3f4f6; display: flex; align-items: center; justify-content: space-between;">'
-                        all_cards += f'<div style="display: flex; gap: 16px; font-size: 12px; font-weight: 500; color: #6b7280;"><span style="display: flex; align-items: center; gap: 4px;">🧳 Included</span><span style="display: flex; align-items: center; gap: 4px;">💺 Economy</span></div>'
-                        all_cards += f'<a href="{booking_url}" style="background: #111827; color: white; text-decoration: none; padding: 12px 28px; border-radius: 8px; font-weight: 600; font-size: 14px; transition: all 0.2s; display: inline-block; box-shadow: 0 2px 4px rgba(0,0,0,0.1);">Select Flight →</a></div>'
-                        
-                        all_cards += '</div>'
-                    
-                    all_cards += '<div style="text-align:center; margin-top: 32px; padding-top: 24px; border-top: 1px solid #e5e7eb;"><p style="color: #9ca3af; font-size: 12px; margin: 0;">Prices include all taxes and fees • 24/7 Support</p></div></div>'
-                    return all_cards
-                else:
-                    return f"<div style='padding: 20px; color: red; background: #fee; border-radius: 8px; font-family: sans-serif;'>{result.get('error')}</div>"
-            elif tool_call.function.name == "get_offer":
-                args = json.loads(tool_call.function.arguments)
-                result = get_offer(offer_id=args.get("offer_id"))
-                if result.get("success"):
-                    offer = result.get("offer", {})
-                    total_amount = result.get("total_amount")
-                    total_currency = result.get("total_currency")
-                    passenger_ids = result.get("passenger_ids", [])
-                    return f"✅ Offer retrieved successfully. Current price: {total_amount} {total_currency}.\n\nIMPORTANT for Agent: You MUST use these Passenger IDs for the booking: {passenger_ids}\n\nPlease collect passenger details (Name, DOB, Gender, Email, Phone + Country Code)."
-                elif result.get("expired"):
-                    return f"⚠️ {result.get('error')} You can still proceed with booking using the original offer price."
-                else:
-                    return f"<div style='padding: 20px; color: red; background: #fee; border-radius: 8px; font-family: sans-serif;'>{result.get('error')}</div>"
-            elif tool_call.function.name == "create_order":
-                args = json.loads(tool_call.function.arguments)
-                result = create_order(
-                    offer_id=args.get("offer_id"), 
-                    passengers=args.get("passengers"), 
-                    payment_type=args.get("payment_type", "balance"),
-                    total_amount=args.get("total_amount"),
-                    total_currency=args.get("total_currency")
-                )
-                if result.get("success"):
-                    booking_ref = result.get("booking_reference")
-                    order_id = result.get("order_id")
-                    return f"""<div style='padding: 24px; background: linear-gradient(135deg, #10b981 0%, #059669 100%); border-radius: 12px; color: white; font-family: sans-serif;'>
-                        <h2 style='margin: 0 0 16px 0; font-size: 24px;'>🎉 Booking Confirmed!</h2>
-                        <p style='margin: 8px 0; font-size: 16px;'><strong>Booking Reference:</strong> {booking_ref}</p>
-                        <p style='margin: 8px 0; font-size: 16px;'><strong>Order ID:</strong> {order_id}</p>
-                        <p style='margin: 16px 0 0 0; font-size: 14px; opacity: 0.9;'>Your flight has been successfully booked. You can use the booking reference to check your reservation on the airline's website.</p>
-                    </div>"""
-                else:
-                    return f"<div style='padding: 20px; color: red; background: #fee; border-radius: 8px; font-family: sans-serif;'>{result.get('error')}</div>"
+    # Text is forwarded as it streams. Tool calls stream one after another, so a call's arguments are
+    # complete once the next call starts; each tool is started right then, while the rest still streams.
+    # Bookings hold their place in the call order but wait for the stream to finish (see BOOKING_TOOLS)
+    started, deferred, pending, has_content = [], [], None, False
+    
+    def start_pending():
+        _, name, arguments = pending
+        if name in BOOKING_TOOLS:
+            deferred.append((len(started), name, arguments))
+            started.append(None)
+        elif name in TOOL_HANDLERS:
+            started.append(start_tool_call(name, arguments))
     
-    return response_msg.content or "Hello! I'm your flight booking assistant. Where would you like to fly today?"
+    try:
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                has_content = True
+                yield delta.content
+            for tool_call in delta.tool_calls or []:
+                if pending is None or tool_call.index != pending[0]:
+                    if pending is not None:
+                        start_pending()
+                    pending = [tool_call.index, "", ""]
+                if tool_call.function:
+                    pending[1] += tool_call.function.name or ""
+                    pending[2] += tool_call.function.arguments or ""
+        if pending is not None:
+            start_pending()
+        for i, name, arguments in deferred:
+            started[i] = start_tool_call(name, arguments)
+        
+        if started:
+            async for chunk in stream_tool_outputs(started, separate=has_content):
+                yield chunk
+        elif not has_content:
+            yield "Hello! I'm your flight booking assistant. Where would you like to fly today?"
+    finally:
+        bookings = {i: name for i, name, _ in deferred}
+        for i, call in enumerate(started):
+            if call is None:
+                continue # Never started, as the stream broke off first
+            queue, task = call
+            if i in bookings:
+                finish_in_background(bookings[i], queue, task)
+            else:
+                task.cancel()
 
 agent.deploy(prod=False)
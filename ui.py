@@ -49,3 +49,33 @@ intro = """
 </div>
 
 """
+
+# Main container styling for flight results: Fixed height wrapper to contain layout during streaming
+# Includes animation styles for staggered card entry
+flights_style = '<style>@keyframes slideUpFade{from{opacity:0;transform:translateY(20px)}to{opacity:1;transform:translateY(0)}} .flight-container { width: 100%; } @media (min-width: 768px) { .flight-container { min-width: 600px; } }</style>' \
+    '<div class="flight-container" style="min-height:600px; box-sizing:border-box; font-family:-apple-system,BlinkMacSystemFont,\'Segoe UI\',Roboto,Helvetica,Arial,sans-serif;">'
+
+flights_heading = '<div style="margin-bottom:24px; text-align:center; animation:slideUpFade 0.5s ease-out forwards;"><h2 style="margin:0; font-size:24px; font-weight:700; color:#111827;">✈️ Flights to {{ destination }}</h2><p style="margin:8px 0 0 0; color:#6b7280; font-size:14px;">Found {{ count }} options from {{ origin }}</p></div>'
+
+flight_card = (
+    '<div style="background:#ffffff; border-radius:16px; box-shadow:0 4px 20px rgba(0,0,0,0.08); margin-bottom:24px; overflow:hidden; width:100%; border:1px solid #f3f4f6; opacity:0; animation:slideUpFade 0.5s ease-out {{ anim_delay }}s forwards;">'
+    # Header: Airline & Price
+    '<div style="padding: 20px 24px; border-bottom: 1px solid #f3f4f6; display: flex; justify-content: space-between; align-items: center; background: #ffffff;">'
+    '<div style="display: flex; align-items: center; gap: 12px;">'
+    '<div style="width: 40px; height: 40px; background: #f3f4f6; border-radius: 10px; display: flex; align-items: center; justify-content: center; color: #4b5563;"><svg style="width:20px;height:20px;" fill="none" stroke="currentColor" viewBox="0 0 24 24"><path stroke-linecap="round" stroke-linejoin="round" stroke-width="2" d="M12 19l9 2-9-18-9 18 9-2zm0 0v-8"></path></svg></div>'
+    '<div><h3 style="margin: 0; font-size: 16px; font-weight: 700; color: #111827;">{{ flight.airline }}</h3><div style="font-size: 12px; color: #6b7280; margin-top: 2px;">Flight {{ idx }}</div></div>'
+    '</div><div style="text-align: right;"><div style="font-size: 20px; font-weight: 800; color: #111827;">{{ price_amount }} <span style="font-size: 14px; font-weight: 500; color: #6b7280;">{{ price_currency }}</span></div></div></div>'
+    # Body: Times & Route
+    '<div style="padding: 24px; display: flex; align-items: center; justify-content: space-between; gap: 16px;">'
+    '<div style="text-align: left; flex: 1;"><div style="font-size: 24px; font-weight: 700; color: #111827; line-height: 1.2;">{{ flight.departure }}</div><div style="font-size: 14px; font-weight: 600; color: #9ca3af; margin-top: 4px;">{{ origin }}</div></div>'
+    '<div style="flex: 2; display: flex; flex-direction: column; align-items: center; position: relative; padding: 0 10px;"><div style="font-size: 12px; font-weight: 600; color: #6b7280; margin-bottom: 8px;">{{ flight.duration }}</div>'
+    '<div style="width: 100%; height: 2px; background: #e5e7eb; position: relative; border-radius: 2px;"><div style="position: absolute; top: 50%; left: 50%; transform: translate(-50%, -50%); background: {{ stops_color }}; padding: 0 8px; font-size: 10px; font-weight: 700; color: white; border-radius: 10px; line-height: 16px; white-space: nowrap;">{{ stops_text }}</div></div></div>'
+    '<div style="text-align: right; flex: 1;"><div style="font-size: 24px; font-weight: 700; color: #111827; line-height: 1.2;">{{ flight.arrival }}</div><div style="font-size: 14px; font-weight: 600; color: #9ca3af; margin-top: 4px;">{{ destination }}</div></div></div>'
+    # Footer: Action
+    '<div style="padding: 16px 24px; background: #f9fafb; border-top: 1px solid #f3f4f6; display: flex; align-items: center; justify-content: space-between;">'
+    '<div style="display: flex; gap: 16px; font-size: 12px; font-weight: 500; color: #6b7280;"><span style="display: flex; align-items: center; gap: 4px;">🧳 Included</span><span style="display: flex; align-items: center; gap: 4px;">💺 Economy</span></div>'
+    '<a href="{{ booking_url }}" style="background: #111827; color: white; text-decoration: none; padding: 12px 28px; border-radius: 8px; font-weight: 600; font-size: 14px; transition: all 0.2s; display: inline-block; box-shadow: 0 2px 4px rgba(0,0,0,0.1);">Select Flight →</a></div>'
+    '</div>'
+)
+
+flights_footer = '<div style="text-align:center; margin-top: 32px; padding-top: 24px; border-top: 1px solid #e5e7eb;"><p style="color: #9ca3af; font-size: 12px; margin: 0;">Prices include all taxes and fees • 24/7 Support</p></div></div>'